@@ -117,7 +117,7 @@ def download_image(url):
     try:
         response = requests.get(url, timeout=30)
         if response.status_code == 200:
-            image_array = np.asarray(bytearray(response.content), dtype=np.uint8)
+            image_array = np.frombuffer(response.content, dtype=np.uint8)
             img = cv2.imdecode(image_array, cv2.IMREAD_UNCHANGED)
             if img is None:
                 return None, f"Downloaded data is not a valid image (Content-Type: {response.headers.get('Content-Type', 'unknown')}, size: {len(response.content)} bytes)"
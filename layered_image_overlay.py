@@ -89,7 +89,7 @@ def download_image(url, keep_alpha=False):
         r = requests.get(url, timeout=30)
         if r.status_code != 200:
             return None, f"HTTP {r.status_code}: {r.text[:200]}"
-        arr = np.asarray(bytearray(r.content), dtype=np.uint8)
+        arr = np.frombuffer(r.content, dtype=np.uint8)
         img = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED)
         if img is None:
             return None, ("Downloaded data is not a valid image "
@@ -0,0 +1,101 @@
+import cv2
+import numpy as np
+
+from overlay_two_images import blend_over_box, find_transparent_box
+
+
+def contour_box(alpha):
+    """Box picked by the original findContours/largest-contour code."""
+    mask = (alpha < 255).astype(np.uint8) * 255
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    return cv2.boundingRect(max(contours, key=cv2.contourArea))
+
+
+def canvas_blend(overlay_img, ad_resized, x, y, w, h):
+    """Original float blend of the foreground over a black canvas with the ad."""
+    canvas = np.zeros(overlay_img.shape[:2] + (3,), np.float64)
+    canvas[y:y+h, x:x+w] = ad_resized
+    alpha = overlay_img[:, :, 3:4] / 255.0
+    return np.round(overlay_img[:, :, :3] * alpha + canvas * (1 - alpha)).astype(np.uint8)
+
+
+def test_no_transparent_area():
+    alpha = np.full((100, 120), 255, np.uint8)
+    assert find_transparent_box(alpha) is None
+
+
+def test_rectangular_hole():
+    alpha = np.full((300, 400), 255, np.uint8)
+    alpha[40:200, 60:350] = 0
+    assert find_transparent_box(alpha) == (60, 40, 290, 160)
+
+
+def test_overlapping_projections_pick_largest_hole():
+    # The holes' row and column projections overlap into one contiguous run,
+    # but they are separate areas: only the larger one may be returned.
+    alpha = np.full((400, 400), 255, np.uint8)
+    cv2.circle(alpha, (100, 100), 80, 0, -1)
+    cv2.circle(alpha, (250, 250), 90, 0, -1)
+    assert find_transparent_box(alpha) == (160, 160, 181, 181)
+    assert find_transparent_box(alpha) == contour_box(alpha)
+
+
+def test_disjoint_holes_pick_largest():
+    alpha = np.full((500, 600), 255, np.uint8)
+    alpha[100:300, 50:400] = 0
+    alpha[400:420, 500:520] = 0
+    assert find_transparent_box(alpha) == (50, 100, 350, 200)
+
+
+def test_blend_matches_black_canvas_inside_and_outside_box():
+    rng = np.random.default_rng(0)
+    overlay_img = rng.integers(0, 256, (300, 400, 4), dtype=np.uint8)
+    overlay_img[:, :, 3] = 255
+    x, y, w, h = 50, 30, 200, 120
+    overlay_img[y:y+h, x:x+w, 3] = rng.integers(0, 256, (h, w))
+    # A second hole and a soft shadow outside the box composite onto black.
+    overlay_img[200:260, 300:380, 3] = 0
+    overlay_img[160:180, 0:400, 3] = 100
+    ad_resized = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+    result = blend_over_box(overlay_img, ad_resized, x, y, w, h)
+    expected = canvas_blend(overlay_img, ad_resized, x, y, w, h)
+    assert np.array_equal(result, expected)
+    assert not result[200:260, 300:380].any()
+
+
+def test_blend_binary_alpha_copies_ad():
+    rng = np.random.default_rng(1)
+    overlay_img = rng.integers(0, 256, (200, 300, 4), dtype=np.uint8)
+    overlay_img[:, :, 3] = np.where(overlay_img[:, :, 3] < 128, 0, 255)
+    x, y, w, h = 20, 10, 150, 100
+    ad_resized = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+    result = blend_over_box(overlay_img, ad_resized, x, y, w, h)
+    assert np.array_equal(result, canvas_blend(overlay_img, ad_resized, x, y, w, h))
+
+
+def test_thin_strip_between_sample_rows_is_found():
+    # A 7 px strip could hide between rows of a coarse 8 px sampling grid;
+    # it is larger than the square hole, so it must win.
+    alpha = np.full((800, 1200), 255, np.uint8)
+    alpha[401:408, 10:1190] = 0
+    alpha[100:140, 100:140] = 0
+    assert find_transparent_box(alpha) == (10, 401, 1180, 7)
+    assert find_transparent_box(alpha) == contour_box(alpha)
+
+
+def test_thin_boxes_are_exact():
+    alpha = np.full((600, 900), 255, np.uint8)
+    alpha[250, 30:870] = 0
+    assert find_transparent_box(alpha) == (30, 250, 840, 1)
+
+    alpha = np.full((600, 900), 255, np.uint8)
+    alpha[20:580, 451:466] = 128
+    assert find_transparent_box(alpha) == (451, 20, 15, 560)
+
+    alpha = np.full((600, 900), 255, np.uint8)
+    alpha[303, 707] = 0
+    assert find_transparent_box(alpha) == (707, 303, 1, 1)